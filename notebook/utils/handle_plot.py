@@ -1,30 +1,319 @@
+# Caching
+import functools
+import hashlib
+from collections import OrderedDict
+
+# File handling
+import os
+import tempfile
+from pathlib import Path
+
+# Concurrency
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack
+
 # Type hinting
-from typing import Union
+from typing import Dict, List, Optional, Union
 
-# Visualization
+# Serialization
+import orjson
+
+# Visualization, Kaleido and IPython.display are imported on first use
 import plotly.graph_objects as go
-from IPython.display import display
-import kaleido
-import webp
 
 # Configuration
-from utils.config import format, PLOTS, INTERACTIVE
+from utils.config import format, PLOTS, INTERACTIVE, RENDERER, WIDTH, SCALE
+
+
+@functools.cache
+def _check_kaleido_version() -> None:
+    # Warn once per process, on first export rather than on every import
+    import kaleido
+    from packaging.version import Version
+    if Version(kaleido.__version__).release[:2] != (0, 1):
+        # pip install kaleido==0.1.0post1
+        # Restart kernel
+        print('Kaleido version may not work properly. Version 0.1.0.post1 is supported')
+
+
+def _size(width: int, scale: int) -> Dict[str, int]:
+    # Output is width * scale pixels wide, keep it at the displayed width unless publishing
+    return dict(width=width, scale=scale)
+
+
+# Default image export options
+IMAGE_OPTIONS = dict(format=format, **_size(WIDTH, SCALE))
+
+# Serialize exports so concurrent cells don't race on the Kaleido process, also guards _RENDER_CACHE
+_kaleido_lock = threading.Lock()
+# Locks per saved filename, guarded by _file_locks_lock
+_file_locks: Dict[str, threading.Lock] = {}
+_file_locks_lock = threading.Lock()
+# Process umask, read once at import as reading it means briefly setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+# Background workers for async_save, sharing the one Kaleido scope
+_executor = ThreadPoolExecutor(max_workers=2)
+# Formats displayed from their own bytes, as an image MIME bundle that notebook viewers show.
+# Other formats, such as WebP, stay on disk and are converted to PNG in-process for display
+DISPLAY_FORMATS = ('png', 'jpeg', 'jpg')
+
+
+@functools.cache
+def get_kaleido_scope():
+    '''
+    Return the long-lived Kaleido scope shared by every export in the session, configured on first use.
+    '''
+    import plotly.io as pio
+    from plotly.io.json import to_json_plotly
+    _check_kaleido_version()
+    # Serialize the export spec piped to Kaleido with orjson, leaving Plotly's global JSON engine untouched
+    kaleido_scope = pio.kaleido.scope
+    kaleido_scope._json_dumps = lambda spec: to_json_plotly(spec, engine='orjson')
+    for option, value in IMAGE_OPTIONS.items():
+        setattr(kaleido_scope, f'default_{option}', value)
+    return kaleido_scope
+
+
+# Characters in a title that are not safe in a filename
+replace_dict = {',': '_', '!': '_', '?': '_', ' ': '_', ':': '_'}
+# Create the translation table once for all titles
+translation_table = str.maketrans(replace_dict)
+
+
+@functools.lru_cache(maxsize=512)
+def title_to_filename(title: str, save_dir: str = PLOTS) -> str:
+    # One C-level translate pass and a single f-string allocation
+    return f'{save_dir}{title.translate(translation_table)}.{format}'
+
+
+# Rendered image bytes keyed on (figure hash, width, scale, format), least recently used first
+_RENDER_CACHE: 'OrderedDict[tuple, bytes]' = OrderedDict()
+RENDER_CACHE_SIZE = 64
+
+
+def figure_title(fig: go.Figure) -> str:
+    '''
+    Read the title text straight from the layout dict, skipping the validated fig.layout.title.text attribute chain.
+    '''
+    return fig._layout.get('title', {}).get('text')
+
+
+def _to_jsonable(obj):
+    # orjson fallback for values it can't serialize natively, e.g. object dtype arrays
+    return obj.tolist() if hasattr(obj, 'tolist') else str(obj)
+
+
+def figure_hash(fig: go.Figure) -> str:
+    '''
+    Hash the canonical JSON of a figure, structurally equal figures give equal hashes whatever their key order.
+    Equal figures therefore share one cached render.
+    '''
+    data = orjson.dumps(fig.to_dict(), default=_to_jsonable,
+                        option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def render_images(figs: List[go.Figure], width: int = IMAGE_OPTIONS['width'], scale: int = IMAGE_OPTIONS['scale'], hashes: Optional[List[str]] = None) -> List[bytes]:
+    '''
+    Render figures to image bytes with Kaleido, reusing the bytes of identical earlier renders.
+    All figures missing from the cache are rendered in one session of the persistent Kaleido scope.
+
+    Parameters:
+    figs (List[go.Figure]): The Plotly Figure objects to render.
+    width (int): Width of the images in pixels.
+    scale (int): Scale factor applied to the image size.
+    hashes (Optional[List[str]]): Precomputed figure_hash of each figure, computed when None.
+
+    Returns:
+    List[bytes]: The encoded images in the configured format, in the order of figs.
+    '''
+    if hashes is None:
+        hashes = [figure_hash(fig) for fig in figs]
+    keys = [(fig_hash, width, scale, format) for fig_hash in hashes]
+    # The cache is shared with the async_save workers, hold the Kaleido lock from lookup to eviction so
+    # no thread evicts another's renders before it reads them, and a miss is rendered only once
+    with _kaleido_lock:
+        missing = {key: fig for key, fig in zip(keys, figs) if key not in _RENDER_CACHE}
+        if missing:  # Cache miss, render with the persistent Kaleido scope
+            kaleido_scope = get_kaleido_scope()
+            options = {**IMAGE_OPTIONS, **_size(width, scale)}
+            for key, fig in missing.items():
+                _RENDER_CACHE[key] = kaleido_scope.transform(fig, **options)
+
+        images = []
+        for key in keys:
+            _RENDER_CACHE.move_to_end(key)  # Mark as most recently used
+            images.append(_RENDER_CACHE[key])
+        while len(_RENDER_CACHE) > max(RENDER_CACHE_SIZE, len(keys)):
+            _RENDER_CACHE.popitem(last=False)  # Evict the least recently used render
+    return images
+
+
+def render_image(fig: go.Figure, width: int = IMAGE_OPTIONS['width'], scale: int = IMAGE_OPTIONS['scale']) -> bytes:
+    '''
+    Render a single figure to image bytes, see render_images.
+    '''
+    return render_images([fig], width, scale)[0]
+
+
+def _file_lock(filename: str) -> threading.Lock:
+    with _file_locks_lock:
+        return _file_locks.setdefault(os.path.abspath(filename), threading.Lock())
+
+
+def is_saved(filename: str, stamp: str) -> bool:
+    '''
+    Check whether filename holds the render matching stamp, using the hash sidecar written by save_image.
+    '''
+    try:
+        return os.path.exists(filename) and Path(filename + '.hash').read_text() == stamp
+    except OSError:
+        return False
+
+
+def save_image(filename: str, data: bytes, stamp: str) -> None:
+    '''
+    Write the image bytes and record the stamp, the figure hash and size, in a sidecar file next to it.
+    '''
+    _atomic_write(filename, data)
+    # The sidecar is written last, a crash in between leaves the image marked stale
+    _atomic_write(filename + '.hash', stamp.encode())
+
+
+def _atomic_write(filename: str, data: bytes) -> None:
+    # Write to a temporary file in the same folder and rename it over the target,
+    # so a reader never sees a half-written file
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(filename) or '.', suffix='.tmp', delete=False) as tmp:
+        try:
+            tmp.write(data)
+            tmp.close()
+            # Temporary files are owner-only, give the file the permissions a plain open would
+            os.chmod(tmp.name, 0o666 & ~_UMASK)
+            os.replace(tmp.name, filename)
+        except BaseException:
+            os.remove(tmp.name)
+            raise
+
+
+def _to_png(data: bytes) -> bytes:
+    # Re-encode an image, e.g. WebP, as PNG with Pillow, without another Kaleido render
+    from io import BytesIO
+    from PIL import Image as PILImage
+    buffer = BytesIO()
+    with PILImage.open(BytesIO(data)) as img:
+        img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def image_object(data: bytes, fmt: str = format):
+    '''
+    Wrap encoded image bytes in an IPython display object, leaving the decoding to the notebook's browser.
+    Formats outside DISPLAY_FORMATS are converted to PNG first, so viewers get a real image MIME bundle.
+    '''
+    from IPython.display import Image
+    if fmt not in DISPLAY_FORMATS:
+        return Image(data=_to_png(data), format='png')
+    return Image(data=data, format=fmt)
 
-if kaleido.__version__ != '0.1.0.post1':
-    # pip install kaleido==0.1.0post1
-    # Restart kernel
-    print('Kaleido version may not work properly. Version 0.1.0.post1 is supported')
 
+@functools.lru_cache(maxsize=128)
+def _saved_image_object(filename: str, mtime_ns: int):
+    # The modification time is part of the key so a rewritten file is never served stale
+    return image_object(Path(filename).read_bytes())
+
+
+def load_image(filename: str):
+    '''
+    Load a saved image as a display object, reusing it while the file is unchanged on disk.
+    '''
+    return _saved_image_object(filename, os.stat(filename).st_mtime_ns)
+
+
+def _save(figs: List[go.Figure], filenames: List[str], width: int, scale: int) -> Dict[int, bytes]:
+    # Save figs whose saved image is missing or out of date, returning the bytes rendered by position
+    hashes = [figure_hash(fig) for fig in figs]
+    # The sidecar records the size too, so a resized render replaces the saved image
+    stamps = [f'{fig_hash}-{width}x{scale}' for fig_hash in hashes]
+    rendered = {}
+    with ExitStack() as stack:
+        # One renderer per filename, concurrent callers wait here and then find the image saved
+        for filename in sorted(set(filenames)):
+            stack.enter_context(_file_lock(filename))
+        stale = [i for i, (filename, stamp) in enumerate(zip(filenames, stamps))
+                 if not is_saved(filename, stamp)]
+        images = render_images([figs[i] for i in stale], width, scale, [hashes[i] for i in stale])
+        for i, data in zip(stale, images):
+            save_image(filenames[i], data, stamps[i])
+            rendered[i] = data
+    return rendered
+
+
+def _load_images(filenames: List[str], rendered: Dict[int, bytes]) -> list:
+    # Freshly rendered figs from memory, the rest from the saved plots folder without rendering
+    return [image_object(rendered[i]) if i in rendered else load_image(filename)
+            for i, filename in enumerate(filenames)]
+
+
+def _plot_objects(figs: List[go.Figure], save_only: bool, display_only: bool, save_dir: str, renderer: str, titles: Optional[List[Optional[str]]], width: int, scale: int) -> list:
+    # Save the figs as needed and build their display objects, or return the filenames when save_only.
+    # Nothing is displayed here, so this can run on the async_save workers
+    if renderer == 'html' and not save_only:  # Plotly HTML, no Kaleido render
+        # to_html takes no engine argument, Plotly's default 'auto' engine already serializes with orjson when installed
+        from IPython.display import HTML
+        return [HTML(fig.to_html(include_plotlyjs='cdn', full_html=False)) for fig in figs]
+    elif renderer == 'svg' and not save_only:  # Inline SVG, no raster encode and decode
+        from IPython.display import SVG
+        kaleido_scope = get_kaleido_scope()
+        with _kaleido_lock:
+            svgs = [kaleido_scope.transform(fig, format='svg', width=width) for fig in figs]
+        return [SVG(svg) for svg in svgs]
+
+    # Resolve the filenames once for the save and display branches
+    if titles is None:
+        titles = [None] * len(figs)
+    filenames = [title_to_filename(title or figure_title(fig), save_dir) for fig, title in zip(figs, titles)]
+    rendered = {} if display_only else _save(figs, filenames, width, scale)
+    if save_only:  # No display
+        return filenames
+    return _load_images(filenames, rendered)
+
+
+def show_plots(figs: List[go.Figure], save_only: bool = False, display_only: bool = False, save_dir: str = PLOTS, interactive: bool = INTERACTIVE, renderer: str = RENDERER, titles: Optional[List[Optional[str]]] = None, async_save: bool = False, width: int = WIDTH, scale: int = SCALE) -> Union[List[Union[None, str]], Future]:
+    '''
+    Display several plots, rendering all figures that need saving in a single Kaleido round. All figures need a title to be able to create a filename
+
+    Parameters:
+    figs (List[go.Figure]): The Plotly Figure objects to display.
+    save_only (bool): True saves the figs but do not render to display.
+    display_only (bool): True displays or renders the figs from the saved plots and do not attempt to save them.
+    save_dir (str): Directory to save plots, defaults to PLOTS constant.
+    interactive (bool): True displays interactive plots without saving, defaults to INTERACTIVE constant.
+    renderer (str): 'static' saves and displays images, 'svg' and 'html' display inline without saving unless save_only, defaults to RENDERER constant.
+    titles (Optional[List[Optional[str]]]): Titles used for the filenames, read from each fig when None.
+    async_save (bool): True saves and renders in a background thread and returns a Future, ignored when interactive. Display the objects of its .result(), e.g. with IPython's display(*future.result()).
+    width (int): Image width in pixels, defaults to WIDTH constant, the notebook display width.
+    scale (int): Image scale factor, defaults to SCALE constant. Use scale=2 for publication saves.
+
+    Returns:
+    Union[List[Union[None, str]], Future]: One result per figure, as returned by show_plot, or a Future of the display objects (the filenames when save_only) when async_save.
+    '''
+    if interactive:  # Check if in interactive mode, always shown from the calling cell
+        return [fig.show() for fig in figs]
+    elif async_save:  # Hide the render and decode latency behind other cell work
+        # The worker only builds the display objects, IPython would send output displayed from another
+        # thread to whichever cell is running when it finishes
+        return _executor.submit(_plot_objects, figs, save_only, display_only, save_dir, renderer, titles, width, scale)
 
-def title_to_filename(title: str, save_dir: str = PLOTS):
-    replace_dict = {',': '_', '!': '_', '?': '_', ' ': '_', ':': '_'}
-    # Create a translation table
-    translation_table = str.maketrans(replace_dict)
-    filename = save_dir + title.translate(translation_table) + '.' + format
-    return filename
+    objects = _plot_objects(figs, save_only, display_only, save_dir, renderer, titles, width, scale)
+    if save_only:  # The filenames, no display
+        return objects
+    from IPython.display import display
+    return [display(obj) for obj in objects]
 
 
-def show_plot(fig: Union[None, go.Figure] = None, save_only: bool = False, display_only: bool = False, save_dir: str = PLOTS, interactive: bool = INTERACTIVE) -> Union[None, str]:
+def show_plot(fig: Union[None, go.Figure] = None, save_only: bool = False, display_only: bool = False, save_dir: str = PLOTS, interactive: bool = INTERACTIVE, renderer: str = RENDERER, title: Optional[str] = None, async_save: bool = False, width: int = WIDTH, scale: int = SCALE) -> Union[None, str, Future]:
     '''
     Display a plot from either a saved image file or an interactive figure. All figures need a title to be able to create a filename
 
@@ -34,27 +323,20 @@ def show_plot(fig: Union[None, go.Figure] = None, save_only: bool = False, displ
     display_only (bool): True displays or renders the fig from the saved plots and do not attempt to save it.
     save_dir (str): Directory to save plots, defaults to PLOTS constant.
     interactive (bool): True displays and interactive plot without saving, defaults to INTERACTIVE constant. 
+    renderer (str): 'static' saves and displays an image, 'svg' and 'html' display inline without saving unless save_only, defaults to RENDERER constant.
+    title (Optional[str]): Title used for the filename, read from the fig when None.
+    async_save (bool): True saves and renders in a background thread and returns a Future, ignored when interactive. Display its .result(), e.g. with IPython's display(future.result()).
+    width (int): Image width in pixels, defaults to WIDTH constant, the notebook display width.
+    scale (int): Image scale factor, defaults to SCALE constant. Use scale=2 for publication saves.
 
     Returns:
-    Union[None, str]: Returns None if in interactive mode and the displayed image if in non-interactive mode.
+    Union[None, str, Future]: Returns None if in interactive mode and the displayed image if in non-interactive mode, or a Future of the display object (the filename when save_only) when async_save.
     '''
     if fig is None:  # If fig is provided, display interactive figure
         return print('Pass in a plotly figure as argument')
+    elif async_save and not interactive:  # Hide the render and decode latency behind other cell work
+        return _executor.submit(
+            lambda: _plot_objects([fig], save_only, display_only, save_dir, renderer, [title], width, scale)[0])
     else:
-        if interactive:  # Check if in interactive mode
-            return fig.show()
-        elif save_only:  # Save fig, no display
-            filename = title_to_filename(fig.layout.title.text, save_dir)
-            fig.write_image(filename, format=format,
-                            engine='kaleido', width='1280', scale=2)
-            return filename
-        elif display_only:  # Load fig from saved plots folder, no writing to save
-            filename = title_to_filename(fig.layout.title.text, save_dir)
-            img = webp.load_image(f'{filename}')  # Load image file
-            return display(img)  # Display the image
-        else:  # Save and Display
-            filename = title_to_filename(fig.layout.title.text, save_dir)
-            fig.write_image(filename, format=format,
-                            engine='kaleido', width='1280', scale=2)
-            img = webp.load_image(f'{filename}')  # Load image file
-            return display(img)  # Display the image
+        return show_plots([fig], save_only, display_only, save_dir, interactive, renderer, [title],
+                          False, width, scale)[0]
@@ -12,15 +12,22 @@ import pandas as pd
 from dotenv import dotenv_values
 from utils.handle_plot import show_plot
 import plotly.express as px
+from pymongo.client_session import ClientSession
 from pymongo.collection import Collection
-from pymongo.errors import ConnectionFailure
-from pymongo import MongoClient
+from pymongo.change_stream import CollectionChangeStream
+from pymongo.command_cursor import CommandCursor
+from pymongo.errors import ConnectionFailure, OperationFailure
+from pymongo.read_concern import ReadConcern
+from pymongo import IndexModel, MongoClient, ReturnDocument, UpdateOne
 import numpy as np
-from typing import Dict, List, Optional
-import json
-from bson import ObjectId
+from typing import Dict, Iterable, Iterator, List, Optional
+import orjson
+import pickle
 import datetime as dt
+import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import os
 
 
@@ -75,7 +82,17 @@ MONGODB_URL = environment_variables.get("MONGODB_URL")
 # %%
 try:
     uri = f"mongodb+srv://{MONGODB_USERNAME}:{MONGODB_PASSWORD}@{MONGODB_URL}/"
-    client = MongoClient(uri)
+    client = MongoClient(
+        uri,
+        maxPoolSize=16,  # Enough connections for the concurrent inserts
+        minPoolSize=8,  # Keep connections open between cells
+        retryWrites=True,
+        w="majority",  # Acknowledge writes once on a majority of the replica set
+        journal=True,  # and once they are in the journal
+        compressors="zstd,zlib"  # Compress the wire protocol, zstd if the server supports it
+    )
+    # Resolve the srv record, handshake and open the pool once, up front
+    client.admin.command("ping")
     db = client["ecommerce_db"]
     # collection = database["<collection name>"]
     # start example code here
@@ -85,10 +102,11 @@ except Exception as e:
     raise Exception("Oops, an error occurred: ", e)
 
 # %% [markdown]
-# - List collections in the database
+# - List collections in the database once, so the collections below are only created when missing
 
 # %%
-db.list_collection_names()
+existing = set(db.list_collection_names())
+existing
 
 # %% [markdown]
 # ## 2. Dataset
@@ -186,7 +204,8 @@ db.list_collection_names()
 # The customers collection will store customer information such as name, email, and address. We can validate the schema to ensure that fields like name, email, and address are present and formatted correctly.
 
 # %%
-db.create_collection("customers", validator={
+# Validation schema, attached once the data is inserted
+customers_validator = {
     "$jsonSchema": {
         "bsonType": "object",
         "required": ["customer_id", "name", "email", "address"],
@@ -220,14 +239,18 @@ db.create_collection("customers", validator={
             }
         }
     }
-})
+}
+
+if "customers" not in existing:
+    db.create_collection("customers")
 
 # %% [markdown]
 # ### 2. Products Collection
 # The products collection will store details about each product, including `product_name`, `category`, and `price`.
 
 # %%
-db.create_collection("products", validator={
+# Validation schema, attached once the data is inserted
+products_validator = {
     "$jsonSchema": {
         "bsonType": "object",
         "required": ["product_id", "product_name", "category", "price"],
@@ -256,7 +279,10 @@ db.create_collection("products", validator={
             }
         }
     }
-})
+}
+
+if "products" not in existing:
+    db.create_collection("products")
 
 
 # %% [markdown]
@@ -264,7 +290,8 @@ db.create_collection("products", validator={
 # The orders collection will store details of each order, including the `order_id`, `customer_id` (reference to a customer), `order_date`, and `status`.
 
 # %%
-db.create_collection("orders", validator={
+# Validation schema, attached once the data is inserted
+orders_validator = {
     "$jsonSchema": {
         "bsonType": "object",
         "required": ["order_id", "customer_id", "order_date", "status"],
@@ -291,7 +318,10 @@ db.create_collection("orders", validator={
             }
         }
     }
-})
+}
+
+if "orders" not in existing:
+    db.create_collection("orders")
 
 
 # %% [markdown]
@@ -299,7 +329,8 @@ db.create_collection("orders", validator={
 # The order_items collection will store details of each item in an order, including `order_item_id`, `order_id` (reference to the orders collection), `product_id` (reference to the products collection), `quantity`, and `price`.
 
 # %%
-db.create_collection("order_items", validator={
+# Validation schema, attached once the data is inserted
+order_items_validator = {
     "$jsonSchema": {
         "bsonType": "object",
         "required": ["order_item_id", "order_id", "product_id", "quantity", "price"],
@@ -324,6 +355,18 @@ db.create_collection("order_items", validator={
                 "minimum": 1,
                 "description": "must be a positive integer"
             },
+            "product_name": {
+                "bsonType": "string",
+                "description": "copy of the product's name, embedded at insert"
+            },
+            "category": {
+                "bsonType": "string",
+                "description": "copy of the product's category, embedded at insert"
+            },
+            "unit_price": {
+                "bsonType": "int",
+                "description": "copy of the product's price, embedded at insert"
+            },
             "price": {
                 "bsonType": "int",
                 "minimum": 0,
@@ -331,10 +374,10 @@ db.create_collection("order_items", validator={
             }
         }
     }
-})
+}
 
-# %%
-db.list_collection_names()
+if "order_items" not in existing:
+    db.create_collection("order_items")
 
 # %% [markdown]
 # - Define the collections
@@ -369,7 +412,9 @@ order_items = db['order_items']
 
 def load_json(json_path: Path) -> List[Dict]:
     """
-    Load JSON data from a specified file path and convert any $oid field to ObjectId.
+    Load JSON data from a specified file path, dropping the mock `_id` of each document.
+
+    MongoDB assigns a fresh ObjectId on insert, so the `$oid` values in the file are never rehydrated.
 
     Args:
     json_path (Path): The path to the JSON file.
@@ -377,20 +422,55 @@ def load_json(json_path: Path) -> List[Dict]:
     Returns:
     List[Dict]: A list of dictionaries representing the loaded JSON data.
     """
-    # Open the JSON file and load its content
-    with open(json_path, 'r') as f:
-        json_data = json.load(f)
+    # Open the JSON file and parse its bytes with orjson
+    with open(json_path, 'rb') as f:
+        json_data = orjson.loads(f.read())
 
-    # Convert the $oid field to ObjectId for each document
+    # Drop the mock _id so the server assigns one on insert
     for document in json_data:
-        if "$oid" in document["_id"]:
-            # Replace the $oid field with an actual ObjectId
-            document["_id"] = ObjectId(document["_id"]["$oid"])
+        document.pop("_id", None)
 
     # Return the modified list of documents
     return json_data
 
 
+# %%
+# Load JSON data through a local pickle cache
+
+
+def load_json_cached(json_path: Path) -> List[Dict]:
+    """
+    Load JSON data with load_json, caching the result in a pickle file next to the JSON file.
+
+    The cache is keyed on the modification time and size of the JSON file, so re-runs skip parsing
+    until the file changes.
+
+    Args:
+    json_path (Path): The path to the JSON file.
+
+    Returns:
+    List[Dict]: A list of dictionaries representing the loaded JSON data.
+    """
+    json_path = Path(json_path)
+    cache_path = json_path.with_suffix('.pkl')
+    stat = json_path.stat()
+    # The leading version invalidates caches written by older versions of load_json
+    key = (2, stat.st_mtime_ns, stat.st_size)
+
+    # Return the cached documents if they were built from the current file
+    if cache_path.exists():
+        try:
+            cached_key, json_data = pickle.loads(cache_path.read_bytes())
+            if cached_key == key:
+                return json_data
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            pass  # Corrupt or outdated cache, rebuild it
+
+    json_data = load_json(json_path)
+    cache_path.write_bytes(pickle.dumps((key, json_data), protocol=5))
+    return json_data
+
+
 # %%
 # Function to convert order_date and delivery_date strings to datetime objects
 def convert_date(json_data: List[Dict]) -> List[Dict]:
@@ -417,33 +497,63 @@ def convert_date(json_data: List[Dict]) -> List[Dict]:
                 {"order_date": datetime(2024, 12, 20, 11, 0, 0), "delivery_date": datetime(2024, 12, 21, 16, 30, 0)}
             ]
     """
-    # Iterate over each document (dictionary) in the list of JSON data
-    for document in json_data:
-        # Check if the 'order_date' field exists in the current document
-        if "order_date" in document:
-            # Convert the 'order_date' string to a datetime object using the specified format
-            document['order_date'] = dt.datetime.strptime(
-                document['order_date'], "%Y-%m-%dT%H:%M:%SZ")
-
-        # Check if the 'delivery_date' field exists in the current document
-        if "delivery_date" in document:
-            # Convert the 'delivery_date' string to a datetime object using the specified format
-            document['delivery_date'] = dt.datetime.strptime(
-                document['delivery_date'], "%Y-%m-%dT%H:%M:%SZ")
+    # Parse each date field for all documents in one vectorized pass
+    for field in ("order_date", "delivery_date"):
+        # Collect the date strings, None where the document has no such field
+        dates = [document.get(field) for document in json_data]
+        # Convert all the strings with pandas' C ISO 8601 parser, keeping naive UTC datetimes
+        parsed = pd.to_datetime(
+            dates, format="ISO8601", utc=True, errors="coerce").tz_localize(None).to_pydatetime()
+
+        # Assign the datetime back only where the field exists in the document
+        for document, date in zip(json_data, parsed):
+            if field in document:
+                document[field] = date
 
     # Return the updated JSON data with converted datetime objects
     return json_data
 
 
+# %%
+# Embed product details into order items
+
+
+def embed_product_details(items: Iterable[Dict], products_data: Iterable[Dict]) -> Iterator[Dict]:
+    """
+    Copy the name, category and price of each item's product into the order item.
+
+    With these fields embedded, revenue and top product queries run on order_items alone, without a $lookup.
+
+    Args:
+    items (Iterable[Dict]): The order item documents.
+    products_data (Iterable[Dict]): The product documents.
+
+    Returns:
+    Iterator[Dict]: The order items with product_name, category and unit_price added.
+    """
+    # Map each product_id to its product once
+    products_by_id = {product["product_id"]: product for product in products_data}
+
+    for item in items:
+        product = products_by_id.get(item["product_id"])
+        if product is not None:
+            item["product_name"] = product["product_name"]
+            item["category"] = product["category"]
+            item["unit_price"] = product["price"]
+        yield item
+
+
 # %%
 # Load JSON data for each collection
-customers_data = load_json(CUSTOMERS_DATA)
+customers_data = load_json_cached(CUSTOMERS_DATA)
 
-products_data = load_json(PRODUCTS_DATA)
+products_data = load_json_cached(PRODUCTS_DATA)
 
-orders_data = convert_date(load_json(ORDERS_DATA))
+orders_data = convert_date(load_json_cached(ORDERS_DATA))
 
-order_items_data = load_json(ORDER_ITEMS_DATA)
+# The product details are embedded lazily, as the order items are inserted in batches
+order_items_data = embed_product_details(
+    load_json_cached(ORDER_ITEMS_DATA), products_data)
 
 # %%
 customers_data
@@ -455,58 +565,159 @@ orders_data
 # - Insert documents into each collection
 
 # %%
-# Insert customer data into the 'customers' collection
-customers.insert_many(customers_data)
+# Maximum number of documents sent per insert_many call
+BATCH_SIZE = 1000
 
-# Insert product data into the 'products' collection
-products.insert_many(products_data)
 
-# Insert order data into the 'orders' collection
-orders.insert_many(orders_data)
+def insert_in_batches(collection: Collection, documents: Iterable[Dict], batch_size: int = BATCH_SIZE) -> int:
+    """
+    Insert documents into a collection with unordered bulk writes of at most batch_size documents.
 
-# Insert order item data into the 'order_items' collection
-order_items.insert_many(order_items_data)
+    Unordered inserts let the server apply the writes of a batch in any order and continue past a failed document.
+
+    Args:
+        collection (Collection): The MongoDB collection to insert into.
+        documents (Iterable[Dict]): The documents to insert, a list or a generator such as embed_product_details.
+        batch_size (int): The number of documents per insert_many call.
+
+    Returns:
+        int: The number of documents inserted.
+    """
+    inserted = 0
+    documents = iter(documents)
+    # Take the next batch from the documents until they run out
+    while batch := list(islice(documents, batch_size)):
+        result = collection.insert_many(batch, ordered=False)
+        inserted += len(result.inserted_ids)
+    return inserted
+
+
+# %%
+# Pair each collection with the data to insert into it
+collection_data = [
+    (customers, customers_data),  # Customer data into the 'customers' collection
+    (products, products_data),  # Product data into the 'products' collection
+    (orders, orders_data),  # Order data into the 'orders' collection
+    (order_items, order_items_data)  # Order item data into the 'order_items' collection
+]
+# Only load the collections created above. The dataset _ids are dropped on load, so on a re-run nothing
+# else would stop the order items from being inserted a second time
+collection_data = [
+    (collection, data) for collection, data in collection_data if collection.name not in existing]
+
+# Insert into the new collections concurrently, pymongo releases the GIL while waiting on the network
+with ThreadPoolExecutor(max_workers=max(len(collection_data), 1)) as executor:
+    inserted_counts = list(executor.map(
+        lambda pair: insert_in_batches(*pair), collection_data))
+
+inserted_counts
+
+# %% [markdown]
+# - Create the indexes before running any analytics, so lookups, filters and groupings are served from indexes instead of collection scans
+
+# %%
+# Pair each collection with its indexes, created with one createIndexes command per collection
+collection_indexes = [
+    (customers, [
+        IndexModel([("customer_id", 1)], unique=True),
+        IndexModel([("email", 1)], unique=True),
+        IndexModel([("address.state", 1)])
+    ]),
+    (products, [
+        IndexModel([("product_id", 1)], unique=True),
+        IndexModel([("category", 1)])
+    ]),
+    (orders, [
+        IndexModel([("customer_id", 1)]),
+        IndexModel([("order_id", 1)], unique=True),
+        IndexModel([("status", 1)]),
+        IndexModel([("delivery_date", 1)])
+    ]),
+    (order_items, [
+        # No separate order_id or product_id index, queries on either alone use the prefix of a compound index
+        IndexModel([("order_id", 1), ("product_id", 1)]),
+        # Covers the product revenue pipeline, which then reads the index alone without fetching any document
+        IndexModel([("product_id", 1), ("quantity", 1), ("price", 1)], name="revenue_cover")
+    ])
+]
+
+# Build the indexes of the four collections concurrently
+with ThreadPoolExecutor(max_workers=len(collection_indexes)) as executor:
+    index_names = list(executor.map(
+        lambda pair: pair[0].create_indexes(pair[1]), collection_indexes))
+
+index_names
+
+# %% [markdown]
+# - Attach the validation schemas now that the data is inserted, so the bulk insert is not validated document by document
+
+# %%
+validators = {
+    "customers": customers_validator,
+    "products": products_validator,
+    "orders": orders_validator,
+    "order_items": order_items_validator
+}
+
+for name, validator in validators.items():
+    # Enforce the schema on all inserts and updates from now on
+    db.command("collMod", name, validator=validator, validationLevel="strict")
 
 # %% [markdown]
 # ### Task 2: Analytical Queries
 # Use MongoDB queries and aggregation pipelines to answer the following questions:
 #
 # #### 4.2.1. Which product categories generate the highest revenue?
-# - Using $group to calculate revenue by category.
+# - Using $group to calculate revenue by category, from the category and price embedded in order_items.
 # - Sort the results in descending order.
 
 # %%
+# Let an aggregation spill to disk once its groups are estimated to need more than this many bytes,
+# half of the 100 MB memory limit of a pipeline stage
+ALLOW_DISK_USE_BYTES = 50_000_000
+
+
+def run_agg(collection: Collection, pipeline: List[Dict], est_group_bytes: int = 0) -> CommandCursor:
+    """
+    Run an aggregation pipeline, fetching its results in batches of BATCH_SIZE documents.
+
+    Disk use is only allowed when the estimated memory of the groups warrants it, so small aggregations
+    stay in memory and large ones spill to disk instead of failing.
+
+    Args:
+        collection (Collection): The MongoDB collection to aggregate.
+        pipeline (List[Dict]): The aggregation pipeline.
+        est_group_bytes (int): The estimated memory of the groups, the number of groups times the bytes per group.
+
+    Returns:
+        CommandCursor: The cursor over the results.
+    """
+    return collection.aggregate(
+        pipeline,
+        allowDiskUse=est_group_bytes > ALLOW_DISK_USE_BYTES,
+        batchSize=BATCH_SIZE
+    )
+
+
+# %%
+# Category and unit price are embedded in each order item, so no join with products is needed
 pipeline = [
-    # Step 1: Join order_items with products collection to get category information
-    {
-        "$lookup": {
-            "from": "products",  # Join with the products collection
-            "localField": "product_id",  # Field from order_items to match with products collection
-            "foreignField": "product_id",  # Field from products collection to match
-            "as": "product_info"  # Output field that will hold the matched documents
-        }
-    },
-    # Step 2: Unwind the product_info array to make category field accessible
-    {
-        "$unwind": "$product_info"
-    },
-    # Step 3: Calculate revenue by multiplying price and quantity
+    # Step 1: Filter out items that can't generate revenue or have no known product
     {
-        "$addFields": {
-            "revenue": {
-                "$multiply": ["$quantity", "$product_info.price"]
-            }
+        "$match": {
+            "quantity": {"$gt": 0},
+            "category": {"$exists": True}
         }
     },
-    # Step 4: Group by category and sum the revenue for each category
+    # Step 2: Group by category and sum the revenue, price times quantity, for each category
     {
         "$group": {
-            "_id": "$product_info.category",  # Group by product category
+            "_id": "$category",  # Group by product category
             # Sum the revenue for each category
-            "total_revenue": {"$sum": "$revenue"}
+            "total_revenue": {"$sum": {"$multiply": ["$quantity", "$unit_price"]}}
         }
     },
-    # Step 5: Rename _id to product_category
+    # Step 3: Rename _id to product_category
     {
         "$project": {
             "product_category": "$_id",  # Rename _id to product_category
@@ -514,7 +725,7 @@ pipeline = [
             "_id": 0  # Exclude the _id field
         }
     },
-    # Step 6: Sort the results in descending order of total revenue
+    # Step 4: Sort the results in descending order of total revenue
     {
         "$sort": {
             "total_revenue": -1  # Sort by total_revenue in descending order
@@ -523,19 +734,14 @@ pipeline = [
 ]
 
 
-cursor = order_items.aggregate(pipeline)
+cursor = run_agg(order_items, pipeline)
 
-# Convert the cursor to a list
-result = (
-    cursor
-    .to_list(length=None)  # `length=None` loads all the results
-)
+# Build the DataFrame from the cursor with named columns, from_records still collects all the rows first
+df = pd.DataFrame.from_records(
+    cursor, columns=["product_category", "total_revenue"])
 
 
 # %%
-# Convert results into a pandas DataFrame
-df = pd.DataFrame(result, columns=["product_category", "total_revenue"])
-
 df
 
 # %% [markdown]
@@ -579,134 +785,40 @@ show_plot(fig)
 # #### 4.2.2. What is the average delivery time for orders?
 #
 # - Calculate the difference between order_date and delivery_date.
-# - Use $group to calculate the average delivery time.
+# - Fetch the delivered orders once and compute the delivery times with vectorized pandas operations. Each order has a single delivery time, so there is nothing for a server-side $group to reduce.
 
 # %%
-pipeline = [
-    # Step1: Convert delivery_date and order_date to ISODate if they are strings
-    {
-        "$addFields": {
-            "delivery_date": {"$toDate": "$delivery_date"},
-            "order_date": {"$toDate": "$order_date"}
-        }
-    },
-    # Step 2: Group all orders to calculate the average delivery time in milliseconds
-    {
-        "$addFields": {
-            "delivery_time_ms": {"$subtract": ["$delivery_date", "$order_date"]}
-        }
-    },
-    # Step 3: Group all orders to calculate the average delivery time in milliseconds
-    {
-        "$group": {
-            "_id": None,  # No grouping key, calculate for all orders
-            "average_delivery_time": {"$avg": "$delivery_time_ms"}
-        }
-    },
-    # Step 4: Convert the average delivery time from milliseconds to days
-    {
-        "$project": {
-            "_id": 0,
-            "average_delivery_time_ms": "$average_delivery_time",
-            "average_delivery_time_days": {
-                "$divide": [
-                    "$average_delivery_time",
-                    1000 * 60 * 60 * 24  # Convert milliseconds to days
-                ]
-            }
-        }
-    }
-]
-
-# Execute the pipeline
-cursor = orders.aggregate(pipeline)
-
-# Convert the cursor to a list
-result = cursor.to_list()
+# Fetch the dates of every delivered order in one query, only the fields needed
+cursor = orders.find(
+    {"delivery_date": {"$exists": True}},  # Only include orders with a delivery_date field
+    {"_id": 0, "order_id": 1, "order_date": 1, "delivery_date": 1},
+    batch_size=BATCH_SIZE  # Fetch in large batches, fewer getMore round trips
+)
+# Give the dates a datetime dtype even when no order is delivered, so the subtraction below still works
+delivered = pd.DataFrame.from_records(
+    cursor, columns=["order_id", "order_date", "delivery_date"]
+).astype({"order_date": "datetime64[ns]", "delivery_date": "datetime64[ns]"})
 
+# Subtract order_date from delivery_date for all orders at once
+delivery_seconds = (delivered["delivery_date"] -
+                    delivered["order_date"]).dt.total_seconds()
 
 # Extract and display the average delivery time
-if result:
-    avg_delivery_time_ms = result[0]["average_delivery_time_ms"]
-    avg_delivery_time_days = result[0]["average_delivery_time_days"]
+if not delivered.empty:
+    avg_delivery_time_ms = delivery_seconds.mean() * 1000
+    avg_delivery_time_days = delivery_seconds.mean() / (60 * 60 * 24)  # Convert seconds to days
     print(
         f"Average Delivery Time: {avg_delivery_time_ms:.2f} milliseconds or {avg_delivery_time_days:.2f} days")
 else:
     print("No data available.")
 
-
 # %%
-# Pipeline for calculating the delivery time per order that has been delivered
-pipeline = [
-    # Step 1: Match documents that have a 'delivery_date' field
-    {
-        "$match": {
-            # Only include documents with a delivery_date field
-            "delivery_date": {"$exists": True}
-        }
-    },
-
-    # Step 2: Convert 'delivery_date' and 'order_date' to Date type
-    {
-        "$addFields": {
-            # Convert 'delivery_date' to a Date object
-            "delivery_date": {"$toDate": "$delivery_date"},
-            # Convert 'order_date' to a Date object
-            "order_date": {"$toDate": "$order_date"}
-        }
-    },
-
-    # Step 3: Calculate the delivery time in milliseconds
-    {
-        "$addFields": {
-            # Subtract order_date from delivery_date to get delivery time in milliseconds
-            "delivery_time_ms": {"$subtract": ["$delivery_date", "$order_date"]}
-        }
-    },
-
-    # Step 4: Group by 'order_id' and calculate the average delivery time in milliseconds
-    {
-        "$group": {
-            "_id": "$order_id",  # Group by order_id
-            # Calculate the average delivery time in milliseconds
-            "average_delivery_time_ms": {"$avg": "$delivery_time_ms"}
-        }
-    },
-
-    # Step 5: Project the required fields and convert the delivery time to days
-    {
-        "$project": {
-            "_id": 0,  # Exclude the default _id field
-            "order_id": "$_id",  # Include order_id in the result
-            "average_delivery_time_ms": 1,  # Include the calculated average delivery time in ms
-            "average_delivery_time_days": {
-                "$divide": [
-                    "$average_delivery_time_ms",  # Use the average delivery time in milliseconds
-                    1000 * 60 * 60 * 24  # Convert milliseconds to days
-                ]
-            }
-        }
-    },
-
-    # Step 6: Sort the results in descending order of average_delivery_time_ms
-    {
-        "$sort": {
-            # Sort by average_delivery_time_ms in descending order
-            "average_delivery_time_ms": -1
-        }
-    }
-]
-
-# Execute the pipeline
-cursor = orders.aggregate(pipeline)
-
-# Convert the cursor to a list
-result = cursor.to_list()
-
-# %%
-# Convert results into a pandas DataFrame
-df = pd.DataFrame(result, columns=[
-                  "order_id", "average_delivery_time_ms", "average_delivery_time_days"])
+# Delivery time per order in milliseconds and days, sorted in descending order
+df = pd.DataFrame({
+    "order_id": delivered["order_id"],
+    "average_delivery_time_ms": delivery_seconds * 1000,
+    "average_delivery_time_days": delivery_seconds / (60 * 60 * 24)  # Convert seconds to days
+}).sort_values("average_delivery_time_ms", ascending=False, ignore_index=True)
 df
 
 # %%
@@ -754,7 +866,13 @@ show_plot(fig)
 
 # %%
 pipeline = [
-    # Step 1: Group by state and count the number of customers
+    # Step 1: Sort by state, matching the index so the documents are read from an index scan
+    {
+        "$sort": {
+            "address.state": 1
+        }
+    },
+    # Step 2: Group by state and count the number of customers
     {
         "$group": {
             "_id": "$address.state",  # Group by the 'state' field
@@ -762,7 +880,7 @@ pipeline = [
             "customer_count": {"$sum": 1}
         }
     },
-    # Step 2: Get the state field
+    # Step 3: Get the state field
     {
         "$project": {
             "_id": 0,
@@ -770,7 +888,7 @@ pipeline = [
             "customer_count": 1
         }
     },
-    # Step 3: Sort the results by customer count in descending order
+    # Step 4: Sort the results by customer count in descending order
     {
         "$sort": {
             "customer_count": -1  # -1 for descending order
@@ -779,14 +897,13 @@ pipeline = [
 ]
 
 # Execute the pipeline
-cursor = customers.aggregate(pipeline)
+cursor = run_agg(customers, pipeline)
 
-# Convert the cursor to a list
-result = cursor.to_list()
+# Build the DataFrame from the cursor with named columns, from_records still collects all the rows first
+df = pd.DataFrame.from_records(cursor, columns=["state", "customer_count"])
 
 
 # %%
-df = pd.DataFrame(result, columns=["state", "customer_count"])
 
 # Add text labels to the map with both state name and customer count
 df['text_label'] = df['state'] + ": " + df['customer_count'].astype(str)
@@ -849,56 +966,49 @@ show_plot(fig)
 # %% [markdown]
 # **2.4. What are the top 3 most expensive products sold in each order?**
 #
-# - Use $lookup and $sort to find the top products in each order.
+# - Use $topN on the product details embedded in order_items to find the top products in each order.
 
 # %%
+# Product name and price are embedded in each order item, so no join with products is needed
 pipeline = [
-    # Step 1: Join order_items with products to get product details using $lookup
-    {
-        "$lookup": {
-            "from": "products",             # Collection to join with
-            "localField": "product_id",     # Local field in order_items
-            "foreignField": "product_id",   # Foreign field in products
-            "as": "product_details"         # Alias for the resulting array
-        }
-    },
-    # Step 2: Unwind the product_details to flatten the array and make each product its own document
-    {
-        "$unwind": "$product_details"
-    },
-    # Step 3: Sort by price in descending order to find the most expensive products
+    # Step 1: Only keep items with a known product
     {
-        "$sort": {
-            "product_details.price": -1  # Sort by product price in descending order
+        "$match": {
+            "unit_price": {"$exists": True}
         }
     },
-    # Step 4: Group by order_id and get the top 3 most expensive products
+    # Step 2: Group by order_id and keep the top 3 most expensive products (MongoDB 5.2+)
     {
         "$group": {
             "_id": "$order_id",  # Group by order_id
             "top_products": {  # Store the top products for each order
-                "$push": {
-                    "product_name": "$product_details.product_name",
-                    "price": "$product_details.price",
-                    "quantity": "$quantity",
-                    "total_price": {"$multiply": ["$quantity", "$product_details.price"]}
+                "$topN": {
+                    "n": 3,  # Only 3 products are held per order while grouping
+                    # Sort by product price in descending order
+                    "sortBy": {"unit_price": -1},
+                    "output": {
+                        "product_name": "$product_name",
+                        "price": "$unit_price",
+                        "quantity": "$quantity",
+                        "total_price": {"$multiply": ["$quantity", "$unit_price"]}
+                    }
                 }
             }
         }
     },
-    # Step 5: Limit each group to the top 3 products
+    # Step 3: Rename _id to order_id
     {
         "$project": {
             "order_id": "$_id",
-            # Get only the top 3 products
-            "top_products": {"$slice": ["$top_products", 3]},
+            "top_products": 1,
             "_id": 0
         }
     }
 ]
 
-# Execute the pipeline on the order_items collection
-cursor = order_items.aggregate(pipeline)
+# Execute the pipeline on the order_items collection, one group per order holding its 3 top products of about 200 bytes each
+cursor = run_agg(order_items, pipeline,
+                 est_group_bytes=orders.estimated_document_count() * 3 * 200)
 
 # Convert the cursor to a list
 result = cursor.to_list()
@@ -908,13 +1018,12 @@ df = (pd.DataFrame(result))
 df
 
 # %%
-# Expand the 'top_products' column
-expanded_df = df.explode("top_products").reset_index(drop=True)
-expanded_df = pd.concat(
-    [expanded_df.drop(columns=["top_products"]),
-     expanded_df["top_products"].apply(pd.Series)],
-    axis=1
-)
+# Expand the 'top_products' column, one row per product with its order_id
+expanded_df = pd.json_normalize(
+    result, record_path="top_products", meta=["order_id"])
+# Keep order_id as the first column
+expanded_df = expanded_df[["order_id", "product_name",
+                           "price", "quantity", "total_price"]]
 
 # Display the result
 expanded_df
@@ -973,45 +1082,101 @@ show_plot(fig)
 # - **Customer Segmentation**: Grouping customers based on their tendency to purchase higher-end vs. budget-friendly products can help tailor personalized offers, discounts, and promotions to increase customer retention and maximize order value.
 
 # %%
+# Each order item carries its product_id, quantity and price, so the revenue is grouped on order_items alone.
+# The product names are joined after grouping and limiting, so products is looked up once per top product
+# rather than once per item.
 pipeline = [
-    {"$lookup": {
-
-        "from": "order_items",
-
-        "localField": "order_id",
-
-        "foreignField": "order_id",
-
-        "as": "order_details"
-
-    }},
-
-    {"$unwind": "$order_details"},
-
-    {"$group": {
-
-        "_id": "$order_details.product_id",
-
-        "total_revenue": {"$sum": {"$multiply": ["$order_details.quantity", "$order_details.price"]}}
-
-    }},
+    # Step 1: Sort by product so the revenue_cover index is scanned, its keys hold every field used below
+    {"$sort": {"product_id": 1}},
+    # Step 2: Keep only the product and the revenue of each item, quantity times price
+    {
+        "$project": {
+            "_id": 0,
+            "product_id": 1,
+            "revenue": {"$multiply": ["$quantity", "$price"]}
+        }
+    },
+    # Step 3: Group by product and sum the revenue of its items
+    {
+        "$group": {
+            "_id": "$product_id",  # Group by product
+            "total_revenue": {"$sum": "$revenue"}
+        }
+    },
+    # Step 4: Sort the results in descending order of total revenue
+    {"$sort": {"total_revenue": -1}},
+    # Step 5: Keep the top 10 products only, the sort then keeps just the 10 best seen so far in memory
+    {"$limit": 10},
+    # Step 6: Join the product name, served by the unique product_id index on products
+    {
+        "$lookup": {
+            "from": "products",
+            "localField": "_id",
+            "foreignField": "product_id",
+            "pipeline": [{"$project": {"_id": 0, "product_name": 1}}],
+            "as": "product"
+        }
+    },
+    # Step 7: Rename _id to product_id and flatten the product name
     {
         "$project": {
             "product_id": "$_id",
+            "product_name": {"$first": "$product.product_name"},
             "total_revenue": 1,
             "_id": 0
         }
-    },
-    {"$sort": {"total_revenue": -1}}
-
+    }
 ]
 
-cursor = orders.aggregate(pipeline)
+cursor = run_agg(order_items, pipeline)
 
-result = cursor.to_list()
+# Build the DataFrame from the cursor with named columns, from_records still collects all the rows first,
+# with fixed column types so they do not depend on the values returned (or on an empty result)
+df = pd.DataFrame.from_records(
+    cursor, columns=["product_id", "product_name", "total_revenue"]
+).astype({"product_id": "int64", "product_name": "string", "total_revenue": "float64"})
+
+# %%
+# Check that the pipeline is answered from the revenue_cover index alone, with no FETCH of the documents
+def winning_plan_stages(explain: Dict) -> List[Dict]:
+    """
+    Collect the stages of the winning plan of the query that reads order_items, from the output of explain.
+
+    The rejected plans and the later pipeline stages, such as the $lookup, are left out.
+
+    Args:
+    explain (Dict): The output of the explain command for an aggregation.
+
+    Returns:
+    List[Dict]: The stages of the winning plan, from the root to the leaves.
+    """
+    # The query is at the top level when the whole pipeline runs in the query engine, in a $cursor stage otherwise
+    if "stages" in explain:
+        query_planner = explain["stages"][0]["$cursor"]["queryPlanner"]
+    else:
+        query_planner = explain["queryPlanner"]
+    winning_plan = query_planner["winningPlan"]
+    winning_plan = winning_plan.get("queryPlan", winning_plan)  # Slot based engine plans nest the query plan
+
+    stages, pending = [], [winning_plan]
+    while pending:
+        stage = pending.pop()
+        stages.append(stage)
+        pending.extend(stage.get("inputStages", []))
+        if "inputStage" in stage:
+            pending.append(stage["inputStage"])
+    return stages
+
+
+explain = db.command("explain", {"aggregate": "order_items", "pipeline": pipeline, "cursor": {}},
+                     verbosity="queryPlanner")
+stages = winning_plan_stages(explain)
+covered = (any(stage["stage"] == "IXSCAN" and stage.get("indexName") == "revenue_cover" for stage in stages)
+           and not any(stage["stage"] == "FETCH" for stage in stages))
+print("Revenue pipeline is covered by revenue_cover" if covered else
+      f"Revenue pipeline is NOT covered by revenue_cover, winning plan stages: {[stage['stage'] for stage in stages]}")
 
 # %%
-df = (pd.DataFrame(result, columns=["product_id", "total_revenue"]))
 df.head()
 
 # %% [markdown]
@@ -1120,13 +1285,14 @@ df.head()
 #
 # #### 4. Order Items Collection
 #
-# **Design**: Referenced
+# **Design**: Referenced, with a few product fields embedded
 #
-# - The `order_items` collection stores the individual items in an order, referencing both the `order_id` (to associate items with orders) and `product_id` (to link items to products). This is a classic example of a referenced schema.
-# - Storing individual items as separate documents in the `order_items` collection is efficient for querying and avoids duplication of product data across orders.
+# - The `order_items` collection stores the individual items in an order, referencing both the `order_id` (to associate items with orders) and `product_id` (to link items to products).
+# - Each item also keeps a copy of its product's `product_name`, `category` and price (`unit_price`), taken when the item is inserted, both on load and in `create_order`.
 #
 # **Reasoning**:
-# - **Efficient Querying**: By referencing `product_id`, you can easily query the details of products associated with an order item without duplicating product data in every order.
+# - **Efficient Querying**: With the product name, category and price embedded, the revenue and top product queries run on `order_items` alone, without a `$lookup` on products. The full product details are still available through `product_id`.
+# - **Historical Accuracy**: The copied fields record the product as it was when ordered, so later product changes do not rewrite past orders.
 # - **Flexibility**: You can add, update, or remove items from an order without needing to modify the main order document, providing more flexibility for managing orders.
 #
 # **Example**:
@@ -1137,7 +1303,10 @@ df.head()
 #   "order_id": 5001,
 #   "product_id": 101,
 #   "quantity": 2,
-#   "price": 1200
+#   "price": 1200,
+#   "product_name": "Laptop",
+#   "category": "Electronics",
+#   "unit_price": 1200
 # }
 # ```
 #
@@ -1162,24 +1331,14 @@ df.head()
 # - **Index on `status`** if filtering orders by status is common.
 #
 # #### 4. Order Items Collection
-# - **Index on `order_id`** to quickly fetch all items in an order.
-# - **Index on `product_id`** for fast lookups of products in order items.
-# - **Compound index on `order_id` and `product_id`** to improve performance when querying items by both order and product.
+# - **Compound index on `order_id` and `product_id`** to improve performance when querying items by both order and product. As `order_id` is its prefix, it also quickly fetches all items in an order, so no separate `order_id` index is needed.
+# - **Compound index on `product_id`, `quantity` and `price`** (`revenue_cover`), which answers the product revenue query from the index alone. As `product_id` is its prefix, it also serves fast lookups of products in order items, so no separate `product_id` index is needed.
+#
+# These indexes are created in Task 1, right after the data is inserted, so the analytical queries in Task 2 already use them.
 
 # %%
-db.customers.create_index([("customer_id", 1)], unique=True)
-db.customers.create_index([("email", 1)], unique=True)
-
-db.products.create_index([("product_id", 1)], unique=True)
-db.products.create_index([("category", 1)])
-
-db.orders.create_index([("customer_id", 1)])
-db.orders.create_index([("order_id", 1)], unique=True)
-db.orders.create_index([("status", 1)])
-
-db.order_items.create_index([("order_id", 1)])
-db.order_items.create_index([("product_id", 1)])
-db.order_items.create_index([("order_id", 1), ("product_id", 1)])
+# List the indexes of each collection
+{name: list(db[name].index_information()) for name in validators}
 
 # %% [markdown]
 # ### **Schema Design Summary**
@@ -1187,7 +1346,7 @@ db.order_items.create_index([("order_id", 1), ("product_id", 1)])
 # - **Customers**: **Embedded schema** for address data, as it is part of the customer’s profile and not expected to change frequently.
 # - **Products**: **Referenced schema** for efficient reuse across multiple orders.
 # - **Orders**: **Referenced schema** to separate order details and items, allowing flexibility and scalability.
-# - **Order Items**: **Referenced schema** to manage each item in an order independently, linked to both orders and products.
+# - **Order Items**: **Referenced schema** to manage each item in an order independently, linked to both orders and products, with the product name, category and price embedded for the analytics.
 
 # %% [markdown]
 # ### Task 4: Advanced Features
@@ -1205,48 +1364,81 @@ db.order_items.create_index([("order_id", 1), ("product_id", 1)])
 # %%
 
 
-def generate_id_from_field(collection: Collection, field: str) -> Optional[int]:
+# Counters collection holding the last ID handed out for each ID field, e.g. {"_id": "order_id", "seq": 90}
+counters = db['counters']
+
+
+def seed_counter(collection: Collection, field: str) -> None:
     """
-    Generates a new ID by finding the maximum value of a specified field in a MongoDB collection.
-    This is useful for auto-generating a new ID based on the current highest value of a particular field, 
-    such as for creating a new order ID or product ID.
+    Seeds the counter of a field with the maximum value of that field in a MongoDB collection.
+    The counter is only ever raised, so seeding again never hands out an ID twice.
 
     Args:
         collection (Collection): The MongoDB collection to query for the field.
-        field (str): The field name whose maximum value will be used to generate the new ID.
+        field (str): The field name whose maximum value seeds the counter.
 
     Returns:
-        Optional[int]: The new ID (one more than the current maximum value). Returns None if no results are found.
+        None
     """
-    # Aggregation pipeline to find the maximum value of the specified field
+    # Aggregation pipeline to find the maximum value of the specified field, under a fixed name
     pipeline = [
         {
             "$group": {
                 "_id": None,  # Grouping by null to get a single result
                 # Find the maximum value of the specified field
-                f"max_{field}": {"$max": f"${field}"}
+                "max_id": {"$max": f"${field}"}
             }
-        }
+        },
+        {"$project": {"_id": 0, "max_id": 1}}  # Example: {'max_id': 90}
     ]
 
-    # Execute the aggregation pipeline on the collection
-    result = collection.aggregate(pipeline)
+    # Get the first (and only) result from the aggregation, None for an empty collection
+    result = next(collection.aggregate(pipeline), None)
+
+    # Default to 0 when the collection is empty or has no value for the field
+    seq = (result["max_id"] or 0) if result else 0
+
+    # Raise the counter to the maximum, creating it if needed
+    counters.update_one({"_id": field}, {"$max": {"seq": seq}}, upsert=True)
+
+
+def generate_id_from_field(field: str, session: Optional[ClientSession] = None, count: int = 1) -> int:
+    """
+    Generates new IDs for a field by incrementing its counter in the counters collection.
+    Unlike scanning the collection for the current highest value, this costs a single document update
+    whatever the size of the collection, and a range of count IDs is allocated by the same single update.
+
+    Args:
+        field (str): The field name to generate a new ID for, such as order_id or product_id.
+        session (Optional[ClientSession]): The session of the transaction the ID is generated in, if any.
+        count (int): The number of consecutive IDs to allocate.
 
-    # Fetch and print the result (Get the first (and only) result from the aggregation)
-    max_id = next(result, None)
+    Returns:
+        int: The first new ID (one more than the last ID handed out), the range being first to first + count - 1.
+    """
+    # Increment the counter and read back its new value in one atomic operation
+    counter = counters.find_one_and_update(
+        {"_id": field},
+        {"$inc": {"seq": count}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+        session=session
+    )
+    return counter["seq"] - count + 1
 
-    _id = None  # Default to None in case no result is returned
-    if max_id:
-        # Extract the maximum value from the result and increment it by 1
-        # Example: {'_id': None, 'max_order_id': 90} -> _id = 91
-        _id = max_id.get(list(max_id)[1]) + 1
 
-    # Return the generated ID or None if no result was found
-    return _id
+# %%
+# Seed the counters once from the IDs already in the collections
+for collection, field in [(orders, "order_id"), (order_items, "order_item_id"), (products, "product_id")]:
+    seed_counter(collection, field)
 
 
 # %%
 
+# Date given to the orders created below, built once rather than parsed on every order
+ORDER_DATE = dt.datetime(2024, 12, 22, 10, 0, 0, tzinfo=dt.timezone.utc)
+
+
 # Define the order creation process
 def create_order(customer_id: int, product_orders: List[Dict[str, int]]) -> None:
     """
@@ -1268,53 +1460,71 @@ def create_order(customer_id: int, product_orders: List[Dict[str, int]]) -> None
     None: This function does not return any value, but prints the result or an error message.
     """
 
+    # Body of the transaction, run again from the start if the transaction is retried
+    def _create_order(session: ClientSession) -> int:
+        # Insert the order document
+        order_id = generate_id_from_field(
+            "order_id", session=session)  # New order id
+
+        order = {
+            "order_id": order_id,
+            "customer_id": customer_id,
+            "order_date": ORDER_DATE,
+            "status": "Processing"
+        }
+        orders.insert_one(order, session=session)
+
+        # Allocate the IDs of all the order items with a single counter update
+        first_item_id = generate_id_from_field(
+            "order_item_id", session=session, count=len(product_orders))
+
+        # Build an order item document for each product ordered
+        items = [
+            {
+                "order_item_id": first_item_id + i,
+                "order_id": order_id,
+                "product_id": product['product_id'],
+                "quantity": product['quantity'],
+                "price": product['price']
+            }
+            for i, product in enumerate(product_orders)
+        ]
+        # Embed the product details, as for the loaded order items, so the analytics also count these items
+        ordered_products = products.find(
+            {"product_id": {"$in": [product['product_id'] for product in product_orders]}},
+            {"_id": 0, "product_id": 1, "product_name": 1, "category": 1, "price": 1},
+            session=session
+        )
+        items = list(embed_product_details(items, ordered_products))
+
+        # Insert all the order items in a single round trip
+        order_items.insert_many(items, session=session, ordered=False)
+
+        # Update the product inventory (reduce stock) of all the products in a single round trip
+        inventory_updates = [
+            UpdateOne(
+                {"product_id": product['product_id']},
+                # Decrease stock by the ordered quantity
+                {"$inc": {"stock": -product['quantity']}}
+            )
+            for product in product_orders
+        ]
+        products.bulk_write(inventory_updates, ordered=False, session=session)
+
+        return order_id
+
     # Start a session for transaction
     with client.start_session() as session:
-        with session.start_transaction():  # Begin transaction
-
-            try:
-                # Insert the order document
-                order_id = generate_id_from_field(
-                    orders, "order_id")  # New order id
-
-                order = {
-                    "order_id": order_id,
-                    "customer_id": customer_id,
-                    # Convert string to datetime,
-                    "order_date": dt.datetime.strptime("2024-12-22T10:00:00Z", "%Y-%m-%dT%H:%M:%SZ"),
-                    "status": "Processing"
-                }
-                orders.insert_one(order, session=session)
-
-                # Insert order items and update inventory for each product ordered
-                for product in product_orders:
-                    product_id = product['product_id']
-                    quantity = product['quantity']
-
-                    # Insert order item document
-                    order_item = {
-                        "order_item_id": generate_id_from_field(order_items, "order_item_id"),
-                        "order_id": order_id,
-                        "product_id": product_id,
-                        "quantity": quantity,
-                        "price": product['price']
-                    }
-                    order_items.insert_one(order_item, session=session)
-
-                    # # Update the product inventory (reduce stock)
-                    # product_update = {
-                    #     "$inc": {"stock": -quantity}  # Decrease stock by the ordered quantity
-                    # }
-                    # products.update_one({"product_id": product_id}, product_update, session=session)
-
-                # Commit the transaction to apply changes
-                session.commit_transaction()
-                print(f"Order {order_id} created successfully.")
+        try:
+            # Run the writes in a transaction, retried on transient errors and committed with the client's
+            # majority write concern
+            order_id = session.with_transaction(
+                _create_order, read_concern=ReadConcern("snapshot"))
+            print(f"Order {order_id} created successfully.")
 
-            except Exception as e:
-                # Abort transaction in case of an error
-                session.abort_transaction()
-                print(f"Oops, an error occurred: {e}")
+        except Exception as e:
+            # The transaction is aborted by with_transaction in case of an error
+            print(f"Oops, an error occurred: {e}")
 
 
 # Example usage of create_order function
@@ -1329,8 +1539,8 @@ def create_order(customer_id: int, product_orders: List[Dict[str, int]]) -> None
 # Find a customer
 customer_id = customers.find_one()['customer_id']
 
-# Generate new product ids
-new_product_id = generate_id_from_field(products, "product_id")
+# Generate two new product ids
+new_product_id = generate_id_from_field("product_id", count=2)
 new_product_id_2 = new_product_id + 1
 
 
@@ -1353,15 +1563,93 @@ create_order(customer_id, [
 #
 
 # %%
+# Collection holding bookkeeping documents, such as the resume token of the orders change stream
+meta = db['meta']
+
+# Changes are handled in batches of at most CHANGE_BATCH_SIZE, each flushed within about CHANGE_BATCH_WINDOW seconds
+CHANGE_BATCH_SIZE = 500
+CHANGE_BATCH_WINDOW = 0.1
+# try_next waits this long for new changes when none are buffered, so it never holds a batch past its window
+CHANGE_MAX_AWAIT_MS = int(CHANGE_BATCH_WINDOW * 1000)
+
+
+def handle_changes(changes: List[Dict]) -> None:
+    """
+    Print a batch of changes from the orders change stream and save the resume token of the last one.
+
+    Args:
+    changes (List[Dict]): The change documents, in stream order.
+
+    Returns:
+    None
+    """
+    print(f"{len(changes)} changes detected:", *changes, sep="\n")
+    # Save the resume token of the last processed change, once per batch
+    meta.update_one({"_id": "orders_token"}, {
+                    "$set": {"token": changes[-1]["_id"]}}, upsert=True)
+
+
+# Server error code of a resume token that is no longer in the oplog
+CHANGE_STREAM_HISTORY_LOST = 286
+
+
+def open_orders_stream(pipeline: List[Dict]) -> CollectionChangeStream:
+    """
+    Open the change stream on the orders collection, resuming after the last processed change if its
+    resume token was saved and is still in the oplog, from the current time otherwise.
+
+    Args:
+    pipeline (List[Dict]): The aggregation pipeline applied to the change events.
+
+    Returns:
+    CollectionChangeStream: The opened change stream, waiting up to CHANGE_MAX_AWAIT_MS for new changes per getMore.
+    """
+    token = meta.find_one({"_id": "orders_token"})
+    if token:
+        try:
+            return orders.watch(pipeline, resume_after=token["token"], max_await_time_ms=CHANGE_MAX_AWAIT_MS)
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAM_HISTORY_LOST:
+                raise
+            # The changes since the saved token are gone, forget it so later runs do not fail the same way
+            print("The saved resume token is no longer in the oplog, watching for new changes only.")
+            meta.delete_one({"_id": "orders_token"})
+    return orders.watch(pipeline, max_await_time_ms=CHANGE_MAX_AWAIT_MS)
+
+
 # Define a function to watch for changes in the orders collection
 
 
-def watch_orders():
+def watch_orders() -> None:
+    """
+    Watch the orders collection for changes and print the changes detected, in batches.
+
+    The resume token of each processed batch is saved in the meta collection, so after a disconnect or
+    restart the stream resumes right after the last processed change instead of missing the changes in between.
+
+    Returns:
+    None: This function does not return any value, but prints the changes or an error message.
+    """
     try:
-        # Start the change stream on the 'orders' collection
-        with orders.watch() as stream:
-            for change in stream:
-                print("Change detected:", change)
+        # Keep only what is monitored of each change, the resume token (_id) must stay for resuming
+        pipeline = [{"$project": {"_id": 1, "operationType": 1, "documentKey": 1, "clusterTime": 1}}]
+
+        # Start the change stream on the 'orders' collection, after the last processed change if possible
+        with open_orders_stream(pipeline) as stream:
+            batch = []
+            deadline = 0.0
+            while stream.alive:
+                # Next change, or None when no change arrived while waiting
+                change = stream.try_next()
+                if change is not None:
+                    if not batch:
+                        deadline = time.monotonic() + CHANGE_BATCH_WINDOW
+                    batch.append(change)
+
+                # Flush the batch when it is full, its window has passed or no more changes are waiting
+                if batch and (change is None or len(batch) >= CHANGE_BATCH_SIZE or time.monotonic() >= deadline):
+                    handle_changes(batch)
+                    batch = []
     except ConnectionFailure as e:
         print("Error connecting to MongoDB:", e)
     except Exception as e:
@@ -1375,7 +1663,7 @@ watch_orders()
 # %% [markdown]
 # **PS:**
 # 1. **watch()**: This method opens a change stream on the collection.
-# 2. **Real-time monitoring**: The `for` loop continuously listens for changes in the collection and prints them when detected.
+# 2. **Real-time monitoring**: The `while` loop continuously pulls changes from the stream with `try_next()` and prints them in small batches, about a tenth of a second after they are detected (plus the time of a round trip to the server).
 # 3. **Types of changes detected**: The stream can detect `insert`, `update`, `delete`, and other operations performed on the collection.
 
 # %% [markdown]
@@ -1387,21 +1675,17 @@ watch_orders()
 # To ensure data integrity in the `products` collection, we can apply a schema validation rule to ensure that all documents include a valid `price` field (greater than 0).
 
 # %%
-# Check if documents match expected types and structure
-valid_documents = []
-invalid_documents = []
-
-for doc in products.find():
-    if isinstance(doc.get("price"), (float, int)):
-        valid_documents.append(doc)
-        print(f"Valid document: {doc}")
-    else:
-        invalid_documents.append(doc)
-        print(f"Invalid document: {doc}")
+# The products validator attached in Task 1 makes the server reject new documents without a valid price.
+# Documents stored before it was attached are checked with a query, so the server returns only the violators.
+invalid_price = {"$nor": [{"price": {"$type": "number", "$gte": 0}}]}  # Missing, not a number or negative
+
+# Only the counts are reported, so no document is transferred or formatted
+invalid_count = products.count_documents(invalid_price)
+valid_count = products.count_documents({}) - invalid_count
 
 # %%
 print(
-    f"There are {len(valid_documents)} valid documents and {len(invalid_documents)} invalid documents.")
+    f"There are {valid_count} valid documents and {invalid_count} invalid documents.")
 
 # %% [markdown]
 # ### NB
@@ -5,4 +5,10 @@ PLOTS = os.path.join(BASE_DIR, 'screenshots/')
 
 format = 'webp'
 
+# Image size, sized for the notebook display column. Pass width=1280, scale=2 to show_plot for publication quality
+WIDTH = 900
+SCALE = 1
+
 INTERACTIVE = False  # False, Display on plots as webp and render to display, works on GitHub. Set to True to use dynamic plots in supported environments
+
+RENDERER = 'static'  # 'static', Save plots as webp and display them as PNG images. 'svg' or 'html' display inline SVG or Plotly HTML without saving, unless save_only